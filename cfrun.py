@@ -1,14 +1,22 @@
 import argparse
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import os
 from pathlib import Path
 import re
+import select
+import shlex
+import shutil
 import subprocess
 import sys
+import threading
 import time
 
 import browser_cookie3
-from bs4 import BeautifulSoup
-from requests import get
+import lxml.html
+import requests
+from requests.adapters import HTTPAdapter
 import requests_cache
 
 from watchdog.observers import Observer
@@ -17,14 +25,47 @@ from watchdog.events import FileSystemEventHandler
 APP_NAME = 'cfrun'
 CACHE_PATH = Path.home() / '.cache' / APP_NAME
 
+requests_cache.install_cache(
+    str(CACHE_PATH),
+    backend='sqlite',
+    expire_after=3600,
+    allowable_methods=('GET',),
+)
+
+SESSION = requests.Session()
+SESSION.headers.update({'User-Agent': 'cfrun/0.1'})
+SESSION.mount('https://', HTTPAdapter(pool_maxsize=8, pool_connections=4))
+
+COOKIES_TTL = 600
+
+@functools.lru_cache(maxsize=1)
+def _cookies(bucket):
+    try:
+        return browser_cookie3.firefox()
+    except:
+        return None
+
+def get_cookies():
+    # Ключ кэша меняется раз в COOKIES_TTL секунд: куки из Firefox
+    # перечитываются не чаще, но и не залёживаются навсегда.
+    return _cookies(int(time.time()) // COOKIES_TTL)
+
+# Кэш компиляции: почти одинаковые исходники собираются мгновенно.
+CCACHE = 'ccache ' if shutil.which('ccache') else ''
+
+# Важна скорость компиляции, а не скорость кода: -pipe не гоняет
+# промежуточные файлы через диск, -O0 выключает оптимизатор.
+CFLAGS = os.environ.get('CFRUN_CFLAGS', '-pipe -O0')
+CXXFLAGS = os.environ.get('CFRUN_CXXFLAGS', '-pipe -O0')
+
 languages = dict(
     c=lambda src: [
         f"{src.with_suffix('')}",
-        f"gcc --std=gnu11 -lm -o {src.with_suffix('')} {src}",
+        f"{CCACHE}gcc {CFLAGS} --std=gnu11 -lm -o {src.with_suffix('')} {src}",
     ],
     cpp=lambda src: [
         f"{src.with_suffix('')}",
-        f"g++ --std=gnu++17 {src} -lm -o {src.with_suffix('')}",
+        f"{CCACHE}g++ {CXXFLAGS} --std=gnu++17 {src} -lm -o {src.with_suffix('')}",
     ],
     cs=lambda src: [
         f"{src.with_suffix('.exe')}",
@@ -32,7 +73,7 @@ languages = dict(
     ],
     d=lambda src: [
         f"{src.with_suffix('')}",
-        f"dmd {src}",
+        f"{CCACHE}dmd {src}",
     ],
     jl='julia',
     hs=lambda src: [
@@ -54,7 +95,7 @@ languages = dict(
     ],
     pas=lambda src: [
         f"{src.with_suffix('')}",
-        f"fpc {src}",
+        f"{CCACHE}fpc {src}",
     ],
     php='php',
     pl='perl',
@@ -68,9 +109,86 @@ languages = dict(
 
 Test = namedtuple('Test', 'name input output')
 
+# Скрипт для долгоживущего питоньего процесса: читает тесты кадрами
+# "<длина>\n<ввод>", исполняет решение заново на каждом кадре и отвечает
+# кадром того же вида с выводом решения. Упавшее решение — штатный
+# случай: трейсбек уходит в унаследованный stderr, а кадр с тем, что
+# решение успело вывести, отправляется как обычно.
+PY_HARNESS = """
+import io, sys, traceback
+source = sys.argv[1]
+try:
+    code = compile(open(source).read(), source, 'exec')
+except:
+    traceback.print_exc()
+    code = None
+stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+while True:
+    header = stdin.readline()
+    if not header:
+        break
+    data = stdin.read(int(header))
+    sys.stdin, sys.stdout = io.TextIOWrapper(io.BytesIO(data)), io.StringIO()
+    try:
+        if code:
+            exec(code, {'__name__': '__main__'})
+    except SystemExit:
+        pass
+    except:
+        traceback.print_exc()
+    result = sys.stdout.getvalue().encode('utf-8')
+    sys.stdin, sys.stdout = sys.__stdin__, sys.__stdout__
+    stdout.write(b'%d\\n' % len(result))
+    stdout.write(result)
+    stdout.flush()
+"""
+
+class PythonRunner:
+    """Гоняет питонье решение в одном долгоживущем процессе,
+    чтобы не платить за запуск интерпретатора на каждом тесте."""
+
+    def __init__(self, run_cmd, source_path):
+        interpreter = shlex.split(run_cmd)[0]
+        self.proc = subprocess.Popen(
+            [interpreter, '-u', '-c', PY_HARNESS, str(source_path)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            close_fds=False,
+        )
+
+    def run(self, input, timeout=2):
+        data = input.encode('utf-8')
+        self.proc.stdin.write(b'%d\n' % len(data))
+        self.proc.stdin.write(data)
+        self.proc.stdin.flush()
+        deadline = time.monotonic() + timeout
+        buf = b''
+        while b'\n' not in buf:
+            buf += self._read_some(deadline, timeout)
+        header, _, buf = buf.partition(b'\n')
+        n = int(header)
+        while len(buf) < n:
+            buf += self._read_some(deadline, timeout)
+        return buf[:n]
+
+    def _read_some(self, deadline, timeout):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not select.select([self.proc.stdout], [], [], remaining)[0]:
+            self.close()
+            raise subprocess.TimeoutExpired(self.proc.args, timeout)
+        chunk = os.read(self.proc.stdout.fileno(), 65536)
+        if not chunk:
+            raise RuntimeError("решение упало")
+        return chunk
+
+    def close(self):
+        self.proc.kill()
+        self.proc.wait()
+
 def is_file_type_known(path):
     return Path(path).suffix[1:] in languages
 
+@functools.lru_cache(maxsize=256)
 def get_commands(source_path):
     commands = languages[Path(source_path).suffix[1:]]
     if callable(commands):
@@ -78,37 +196,79 @@ def get_commands(source_path):
     elif isinstance(commands, str):
         return (commands + ' ' + str(source_path), None)
 
+PROBLEM_RE = re.compile(r'[^A-Za-z][A-Za-z][0-9]?[^A-Za-z]')
+CONTEST_RE = re.compile(r'\d{2,}')
+
+def last_match(pattern, text):
+    match = None
+    for match in pattern.finditer(text):
+        pass
+    return match
+
+@functools.lru_cache(maxsize=256)
 def get_problem_url(source_path):
     full_path = str(Path(source_path).absolute())
-    problem = re.findall(r'[^A-Za-z][A-Za-z][0-9]?[^A-Za-z]', full_path)[-1][1:-1].upper()
+    problem = last_match(PROBLEM_RE, full_path).group()[1:-1].upper()
     try:
         dot_contest = Path(source_path).parent / '.contest'
         contest_url = dot_contest.open().read().strip()
     except:
-        contest = re.findall(r'\d{2,}', full_path)[-1]
+        contest = last_match(CONTEST_RE, full_path).group()
         contest_url = f"https://codeforces.com/contest/{contest}/problem/%s/"
     return contest_url % (problem,)
 
 def normalize_ws(text: str):
     return "\n".join(line.strip() for line in text.strip().split("\n"))
 
+def normalize_ws_bytes(data: bytes):
+    return b"\n".join(line.strip() for line in data.strip().split(b"\n"))
+
 def get_block_text(block):
-    if block.find('div'):
-        text = "\n".join(div.text for div in block.find_all('div'))
+    divs = block.findall('div')
+    if divs:
+        text = "\n".join(div.text_content() for div in divs)
     else:
-        text = block.text
+        text = block.text_content()
     return normalize_ws(text)
 
 def scrape_samples(url):
-    requests_cache.install_cache(str(CACHE_PATH))
-    cookies = browser_cookie3.firefox()
-    soup = BeautifulSoup(get(url, cookies=cookies).content, features="html.parser")
-    blocks = list(soup.find_all('pre'))
-    inputs = [get_block_text(block) for block in blocks[::2]]
-    outputs = [get_block_text(block) for block in blocks[1::2]]
-    return [Test(f"Пример {i+1}", inputs[i], outputs[i]) for i in range(len(inputs))]
+    response = SESSION.get(url, cookies=get_cookies(), stream=True, timeout=10)
+    response.raw.decode_content = True
+    tree = lxml.html.parse(response.raw)
+    blocks = tree.xpath('//div[@class="sample-test"]//pre')
+    return [
+        Test(f"Пример {i}", get_block_text(input), get_block_text(output))
+        for i, (input, output) in enumerate(zip(blocks[::2], blocks[1::2]), 1)
+    ]
+
+def read_tests(test_path):
+    try:
+        text = test_path.read_text()
+    except FileNotFoundError:
+        return None
+    tests = []
+    for block in text.split('### ')[1:]:
+        name, _, body = block.partition('\n')
+        input, marker, output = body.partition('# вывод\n')
+        if not marker:
+            input, output = body, ""
+        tests.append(Test(name.strip(), normalize_ws(input), normalize_ws(output)))
+    return tests
+
+def save_tests(test_path, tests):
+    with test_path.open('w') as f:
+        for test in tests:
+            f.write(f"### {test.name}\n")
+            f.write(test.input + "\n")
+            f.write("# вывод\n")
+            f.write(test.output + "\n")
 
 def get_tests(source_path):
+    test_path = Path(source_path).with_suffix('.test')
+    tests = read_tests(test_path)
+    if tests:
+        print(f"Взял {len(tests)} примеров из {test_path}")
+        return tests
     try:
         url = get_problem_url(source_path)
     except:
@@ -121,20 +281,80 @@ def get_tests(source_path):
         print("Не сумел загрузить примеры")
         return None
     print(f"Ок, загрузил {len(tests)} примеров")
+    save_tests(test_path, tests)
     return tests
 
+# JVM-языкам даём больше времени на холодный старт.
+TIMEOUTS = dict(java=5, kt=5, scala=5)
+DEFAULT_TIMEOUT = 2
+
+def get_timeout(source_path):
+    return TIMEOUTS.get(Path(source_path).suffix[1:], DEFAULT_TIMEOUT)
+
+def run_test(argv, input, timeout):
+    started = time.perf_counter()
+    result = subprocess.run(
+        argv,
+        input=input,
+        stdout=subprocess.PIPE,
+        close_fds=False,
+        timeout=timeout,
+    )
+    return result.stdout, time.perf_counter() - started
+
+def needs_compile(source_path, argv):
+    # Последний аргумент команды запуска — это собранный бинарник
+    # (или jar); если он свежее исходника, пересобирать нечего.
+    target = Path(argv[-1])
+    try:
+        if target.stat().st_mtime >= Path(source_path).stat().st_mtime:
+            print(f"{target} не устарел, не компилирую")
+            return False
+    except OSError:
+        pass
+    return True
+
 def run_tests(source_path):
     run_cmd, compile_cmd = get_commands(source_path)
-    if compile_cmd:
-        print(f"Компилирую: {compile_cmd}")
-        sys.stdout.flush()
-        if subprocess.run(compile_cmd.split()).returncode != 0:
-            print(f"Ошибка компиляции ({compile_cmd})")
-            return
-    print(f"Запускаю: {run_cmd}")
-    tests = get_tests(source_path)
+    argv = shlex.split(run_cmd)
+    # Компиляция ест процессор, загрузка тестов ждёт сеть —
+    # пускаем их одновременно.
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        tests_future = prefetch.submit(get_tests, source_path)
+        if compile_cmd and needs_compile(source_path, argv):
+            print(f"Компилирую: {compile_cmd}")
+            sys.stdout.flush()
+            if subprocess.run(shlex.split(compile_cmd)).returncode != 0:
+                print(f"Ошибка компиляции ({compile_cmd})")
+                return
+        print(f"Запускаю: {run_cmd}")
+        try:
+            tests = tests_future.result()
+        except:
+            print("Не сумел загрузить примеры")
+            tests = None
     if tests:
-        for test in tests:
+        timeout = get_timeout(source_path)
+        runner = None
+        executor = None
+        futures = None
+        if Path(source_path).suffix == '.py':
+            # Тесты идут через один долгоживущий процесс, строго по очереди.
+            runner = PythonRunner(run_cmd, source_path)
+        else:
+            executor = ThreadPoolExecutor(max_workers=min(len(tests), os.cpu_count()))
+            futures = [
+                executor.submit(
+                    run_test,
+                    argv,
+                    test.input.encode('utf-8'),
+                    timeout,
+                ) if test.input and test.output else None
+                for test in tests
+            ]
+        # Ожидаемые ответы уже нормализованы при чтении — кодируем один раз.
+        expected_outputs = [test.output.encode('utf-8') for test in tests]
+        for test, expected, future in zip(tests, expected_outputs, futures or [None] * len(tests)):
             print(test.name, end=": ")
             if not test.input:
                 print(f"пустой ввод!")
@@ -143,24 +363,27 @@ def run_tests(source_path):
                 print(f"пустой вывод!")
                 continue
             sys.stdout.flush()
-            result = subprocess.run(
-                run_cmd.split(),
-                input=test.input,
-                stdout=subprocess.PIPE,
-                encoding='utf-8',
-                timeout=2,
-            )
-            output = normalize_ws(result.stdout)
-            if output == test.output:
-                print("OK")
+            if runner:
+                started = time.perf_counter()
+                output = runner.run(test.input, timeout=timeout)
+                elapsed = time.perf_counter() - started
+            else:
+                output, elapsed = future.result()
+            output = normalize_ws_bytes(output)
+            if output == expected:
+                print(f"OK ({elapsed * 1000:.0f} мс)")
             else:
                 print("ответ не совпал")
                 print("Ожидаемый ответ:")
                 print(test.output)
                 print("Полученный ответ:")
-                print(output)
+                print(output.decode('utf-8', 'replace'))
+        if runner:
+            runner.close()
+        if executor:
+            executor.shutdown()
     else:
-        subprocess.run(run_cmd.split())
+        subprocess.run(argv, close_fds=False)
     return True
 
 def is_ignored(path):
@@ -174,15 +397,42 @@ def handle_file_change(message, path):
         print(f"{message} файл {path}")
         run_tests(path)
 
+DEBOUNCE_SECONDS = 0.15
+
 class Watcher(FileSystemEventHandler):
+    """Редакторы при сохранении выдают пачку событий на один файл
+    (временный файл, переименование, chmod); склеиваем пачку в один запуск."""
+
+    def __init__(self):
+        self._timers = {}
+        # Таймеры срабатывают в своих потоках; запуски должны идти
+        # по одному, иначе две компиляции пишут в один бинарник.
+        self._run_lock = threading.Lock()
+
+    def _schedule(self, message, path):
+        timer = self._timers.pop(path, None)
+        if timer:
+            timer.cancel()
+        timer = threading.Timer(DEBOUNCE_SECONDS, self._fire, args=(message, path))
+        self._timers[path] = timer
+        timer.start()
+
+    def _fire(self, message, path):
+        self._timers.pop(path, None)
+        with self._run_lock:
+            handle_file_change(message, path)
+
     def on_created(self, event):
-        handle_file_change("Создан", event.src_path)
+        self._schedule("Создан", event.src_path)
 
     def on_modified(self, event):
-        handle_file_change("Изменён", event.src_path)
+        self._schedule("Изменён", event.src_path)
 
     def on_moved(self, event):
-        handle_file_change("Переремещён", event.dest_path)
+        # Путь поменялся — закэшированные по нему команды и URL неверны.
+        get_commands.cache_clear()
+        get_problem_url.cache_clear()
+        self._schedule("Переремещён", event.dest_path)
 
 def watch(path):
     print(f"Слежу за изменениями в {path}")
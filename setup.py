@@ -9,11 +9,12 @@ setup(
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.8',
     ],
+    python_requires='>=3.8',
     install_requires=[
         'browser-cookie3',
-        'bs4',
+        'lxml',
         'requests',
         'requests_cache',
         'watchdog',